@@ -1,10 +1,47 @@
 import streamlit as st
 
 st.set_page_config(page_title="liasotech Purchase Analyzer", layout="wide")
+import csv
+import hashlib
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pdfplumber
 import pandas as pd
 import re
 import plotly.express as px
+import plotly.io as pio
+from register_parser import MIN_PAGES_PER_WORKER, MP_CONTEXT, extract_rows
+
+# Item names are Arrow-backed so str.contains/groupby run in Arrow's C++
+# kernels; SKUs repeat across purchases, so they are dictionary-encoded
+REGISTER_DTYPES = {
+    "Item Name": "string[pyarrow]",
+    # float64, not float32: float32 rounds rupee amounts and totals
+    "Quantity": "float64",
+    "Amount": "float64",
+    "Avg Price": "float64",
+    "SKU": "category",
+}
+
+SCATTER_MAX_POINTS = 5000
+PROMPT_TOP_ROWS = 10
+# Per-function bound on cached filter results; the oldest entries are evicted
+# so a long session of filter tweaks cannot grow memory without limit
+CACHE_MAX_ENTRIES = 32
+
+# Keyword -> category, checked in order; first hit wins
+CATEGORY_KEYWORDS = [
+    ("filter", "Filters"),
+    ("pipe", "Pipes"),
+    ("inventory", "Inventory"),
+    ("valve", "Valves"),
+    ("pump", "Pumps"),
+]
+CATEGORIES = [category for _, category in CATEGORY_KEYWORDS] + ["Misc"]
 
 
 # Inject Custom CSS
@@ -31,6 +68,176 @@ body {
 }
 """)
 
+# ---- PDF Parsing ----
+
+
+def tag_category(names):
+    lower = names.str.lower()
+    conds = [
+        lower.str.contains(keyword, regex=False).to_numpy(dtype=bool)
+        for keyword, _ in CATEGORY_KEYWORDS
+    ]
+    return pd.Categorical(np.select(conds, CATEGORIES[:-1], default="Misc"),
+                          categories=CATEGORIES)
+
+
+# Keyed on the raw file bytes so widget reruns skip pdfplumber entirely
+@st.cache_data(show_spinner="Parsing PDF...")
+def parse_pdf(file_bytes: bytes) -> pd.DataFrame:
+    # Workers reopen the PDF by path, so spill the upload to disk first
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "register.pdf")
+        with open(path, "wb") as f:
+            f.write(file_bytes)
+        with pdfplumber.open(path) as pdf:
+            n_pages = len(pdf.pages)
+
+        workers = min(os.cpu_count() or 1, n_pages // MIN_PAGES_PER_WORKER)
+        if workers > 1:
+            size = -(-n_pages // workers)
+            chunks = [
+                range(i, min(i + size, n_pages))
+                for i in range(0, n_pages, size)
+            ]
+            with ProcessPoolExecutor(len(chunks),
+                                     mp_context=MP_CONTEXT) as executor:
+                tsv = "".join(
+                    executor.map(extract_rows, [path] * len(chunks), chunks))
+        else:
+            tsv = extract_rows(path, range(n_pages))
+
+    if tsv:
+        df = pd.read_csv(io.StringIO(tsv),
+                         sep="\t",
+                         header=None,
+                         names=list(REGISTER_DTYPES),
+                         dtype=REGISTER_DTYPES,
+                         thousands=",",
+                         quoting=csv.QUOTE_NONE,
+                         keep_default_na=False)
+    else:
+        df = pd.DataFrame(
+            columns=list(REGISTER_DTYPES)).astype(REGISTER_DTYPES)
+
+    # Only categories present in the file, so .cat.categories is exact
+    df["Category"] = tag_category(df["Item Name"]).remove_unused_categories()
+    return df
+
+
+# ---- Filtering ----
+
+
+# _df is skipped by the hasher; file_key identifies it instead
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def apply_filters(file_key, _df, search, amount, sku, cats):
+    # One boolean mask, one slice: no intermediate frames per filter
+    mask = np.ones(len(_df), dtype=bool)
+    if search:
+        mask &= _df["Item Name"].str.contains(search, case=False,
+                                              regex=False).to_numpy(dtype=bool)
+    if amount > 0:
+        mask &= (_df["Amount"] >= amount).to_numpy()
+    if sku:
+        mask &= _df["SKU"].str.contains(sku, case=False,
+                                        regex=False).to_numpy(dtype=bool)
+    if cats:
+        mask &= _df["Category"].isin(cats).to_numpy()
+    return _df.loc[mask]
+
+
+# ---- Aggregates ----
+
+
+# Keyed on filter_key (file hash + filter values) like apply_filters
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def category_agg(filter_key, _df):
+    return _df.groupby("Category", observed=True).agg(
+        **{
+            "Amount": ("Amount", "sum"),
+            "Quantity": ("Quantity", "sum"),
+            "Avg Price": ("Avg Price", "mean"),
+        }).reset_index()
+
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def item_agg(filter_key, _df):
+    return _df.groupby("Item Name")[["Amount", "Quantity"]].sum()
+
+
+# argpartition picks the top n in O(U); only those n get sorted
+def top_n_items(totals, n):
+    vals = totals.to_numpy()
+    if n < len(vals):
+        idx = np.argpartition(-vals, n)[:n]
+    else:
+        idx = np.arange(len(vals))
+    idx = idx[np.argsort(-vals[idx], kind="stable")]
+    return pd.DataFrame({
+        totals.index.name: totals.index.to_numpy()[idx],
+        totals.name: vals[idx]
+    })
+
+
+# Figures over small aggregate frames are built and serialized once per
+# distinct input; reruns only rehydrate the cached JSON
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def figure_json(kind, data, **kwargs):
+    return getattr(px, kind)(data, **kwargs).to_json()
+
+
+def cached_fig(kind, data, **kwargs):
+    return pio.from_json(figure_json(kind, data, **kwargs))
+
+
+# ---- Chart Fragments ----
+
+
+# Each fragment owns its widgets, so changing them reruns only that block
+@st.fragment
+def render_top_items(item_totals):
+    top_metric = st.selectbox("Top Items By", ["Amount", "Quantity"])
+    chart_type = st.radio("Chart Type", ["Bar", "Pie"], horizontal=True)
+    top_n = st.slider("Top N Items", 5, 30, 10)
+
+    top_data = top_n_items(item_totals[top_metric], top_n)
+
+    if chart_type == "Bar":
+        fig = cached_fig("bar",
+                         top_data,
+                         x="Item Name",
+                         y=top_metric,
+                         title=f"Top {top_n} by {top_metric}",
+                         text_auto=True)
+    else:
+        fig = cached_fig("pie",
+                         top_data,
+                         values=top_metric,
+                         names="Item Name",
+                         title=f"Top {top_n} by {top_metric}")
+
+    st.plotly_chart(fig, use_container_width=True)
+
+
+@st.fragment
+def render_category_tops(filtered_df):
+    cat_metric = st.selectbox("Metric", ["Amount", "Quantity"])
+    per_cat_n = st.slider("Top N per Category", 3, 15, 5)
+
+    tops = (filtered_df.groupby(
+        ["Category", "Item Name"],
+        observed=True)[cat_metric].sum().sort_values(ascending=False).groupby(
+            level=0, observed=True).head(per_cat_n).reset_index())
+
+    for category, top_sub in tops.groupby("Category", observed=True):
+        st.markdown(f"### {category}")
+        fig = cached_fig("bar",
+                         top_sub,
+                         x="Item Name",
+                         y=cat_metric,
+                         text_auto=True)
+        st.plotly_chart(fig, use_container_width=True)
+
+
 # ---- Setup ----
 
 st.title("📊 Liasotech Purchase Register Analyzer")
@@ -43,37 +250,9 @@ uploaded_file = st.file_uploader("📤 Upload your purchase register PDF",
 filtered_df = pd.DataFrame()
 
 if uploaded_file:
-    data = []
-
-    with pdfplumber.open(uploaded_file) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text()
-            if text:
-                for line in text.split('\n'):
-                    match = re.match(
-                        r"^(.*?)\s+([\d,\.]+)\s+₹([\d,\.]+)\s+₹([\d,\.]+)(?:\s+(.*))?$",
-                        line)
-                    if match:
-                        item_name = match.group(1).strip()
-                        qty = float(match.group(2).replace(",", ""))
-                        amount = float(match.group(3).replace(",", ""))
-                        avg_price = float(match.group(4).replace(",", ""))
-                        sku = match.group(5).strip() if match.group(5) else ""
-                        data.append([item_name, qty, amount, avg_price, sku])
-
-    df = pd.DataFrame(
-        data, columns=["Item Name", "Quantity", "Amount", "Avg Price", "SKU"])
-
-    def tag_category(name):
-        name = name.lower()
-        if "filter" in name: return "Filters"
-        elif "pipe" in name: return "Pipes"
-        elif "inventory" in name: return "Inventory"
-        elif "valve" in name: return "Valves"
-        elif "pump" in name: return "Pumps"
-        else: return "Misc"
-
-    df["Category"] = df["Item Name"].apply(tag_category)
+    file_bytes = uploaded_file.getvalue()
+    file_key = hashlib.md5(file_bytes).hexdigest()
+    df = parse_pdf(file_bytes)
 
     st.sidebar.header("🔍 Filters")
 
@@ -89,46 +268,43 @@ if uploaded_file:
                                int(df["Amount"].max()),
                                key="amount")
     sku = st.sidebar.text_input("Filter by SKU", key="sku")
-    categories = sorted(df["Category"].unique())
+    categories = sorted(df["Category"].cat.categories)
     selected_categories = st.sidebar.multiselect("Category",
                                                  categories,
                                                  default=categories,
                                                  key="category")
 
-    filtered_df = df.copy()
-    if search:
-        filtered_df = filtered_df[filtered_df["Item Name"].str.contains(
-            search, case=False)]
-    if amount > 0:
-        filtered_df = filtered_df[filtered_df["Amount"] >= amount]
-    if sku:
-        filtered_df = filtered_df[filtered_df["SKU"].str.contains(sku,
-                                                                  case=False)]
-    if selected_categories:
-        filtered_df = filtered_df[filtered_df["Category"].isin(
-            selected_categories)]
+    cats = tuple(sorted(selected_categories))
+    filtered_df = apply_filters(file_key, df, search, amount, sku, cats)
+    filter_key = (file_key, search, amount, sku, cats)
+    cat_totals = category_agg(filter_key, filtered_df)
+    item_totals = item_agg(filter_key, filtered_df)
 
     st.subheader("📋 Purchase Summary")
     col1, col2, col3 = st.columns(3)
-    col1.metric("Total Amount", f"₹{filtered_df['Amount'].sum():,.2f}")
-    col2.metric("Total Quantity", f"{filtered_df['Quantity'].sum():,.2f}")
-    col3.metric("Unique Items", filtered_df['Item Name'].nunique())
+    col1.metric("Total Amount", f"₹{cat_totals['Amount'].sum():,.2f}")
+    col2.metric("Total Quantity", f"{cat_totals['Quantity'].sum():,.2f}")
+    col3.metric("Unique Items", len(item_totals))
 
     st.subheader("✨ Key Insights")
     try:
-        most_purchased = filtered_df.loc[filtered_df["Quantity"].idxmax()]
-        highest_spend = filtered_df.loc[filtered_df["Amount"].idxmax()]
-        most_expensive = filtered_df.loc[filtered_df["Avg Price"].idxmax()]
+        # One positional argmax over the numeric block covers all three
+        i_qty, i_amount, i_price = filtered_df[[
+            "Quantity", "Amount", "Avg Price"
+        ]].to_numpy().argmax(axis=0)
+        most_purchased = filtered_df.iloc[i_qty]
+        highest_spend = filtered_df.iloc[i_amount]
+        most_expensive = filtered_df.iloc[i_price]
     except:
         most_purchased = highest_spend = most_expensive = None
 
     avg_price = filtered_df["Avg Price"].mean()
-    max_amount = filtered_df["Amount"].max()
+    max_amount = np.nan if highest_spend is None else highest_spend["Amount"]
     st.markdown(f"""
     - 🏆 **Most Purchased:** `{most_purchased['Item Name']}` – {most_purchased['Quantity']:.2f} units  
     - 💰 **Highest Spend:** `{highest_spend['Item Name']}` – ₹{highest_spend['Amount']:,.2f}  
     - 💎 **Most Expensive/unit:** `{most_expensive['Item Name']}` – ₹{most_expensive['Avg Price']:,.2f}  
-    - 📂 **Categories:** {filtered_df["Category"].nunique()}  
+    - 📂 **Categories:** {len(cat_totals)}  
     - 🔢 **Avg Unit Price:** ₹{avg_price:,.2f}  
     - 🚀 **Largest Purchase:** ₹{max_amount:,.2f}
     """)
@@ -141,66 +317,44 @@ if uploaded_file:
 
     st.subheader("📊 Visual Insights")
 
-    top_metric = st.selectbox("Top Items By", ["Amount", "Quantity"])
-    chart_type = st.radio("Chart Type", ["Bar", "Pie"], horizontal=True)
-    top_n = st.slider("Top N Items", 5, 30, 10)
-
-    top_data = filtered_df.groupby("Item Name")[top_metric].sum().nlargest(
-        top_n).reset_index()
-
-    if chart_type == "Bar":
-        fig = px.bar(top_data,
-                     x="Item Name",
-                     y=top_metric,
-                     title=f"Top {top_n} by {top_metric}",
-                     text_auto=True)
-    else:
-        fig = px.pie(top_data,
-                     values=top_metric,
-                     names="Item Name",
-                     title=f"Top {top_n} by {top_metric}")
-
-    st.plotly_chart(fig, use_container_width=True)
+    render_top_items(item_totals)
 
     with st.expander("📁 Spend by Category"):
-        category_summary = filtered_df.groupby(
-            "Category")["Amount"].sum().reset_index()
-        fig2 = px.bar(category_summary,
-                      x="Category",
-                      y="Amount",
-                      text_auto=True)
+        fig2 = cached_fig("bar",
+                          cat_totals,
+                          x="Category",
+                          y="Amount",
+                          text_auto=True)
         st.plotly_chart(fig2, use_container_width=True)
 
     with st.expander("📉 Quantity vs. Unit Price"):
-        fig3 = px.scatter(filtered_df,
-                          x="Quantity",
-                          y="Avg Price",
-                          size="Amount",
-                          color="Category",
-                          hover_name="Item Name",
-                          title="Unit Price vs Quantity")
+        # Past this many rows, bin into a heatmap instead of one marker per row
+        if len(filtered_df) > SCATTER_MAX_POINTS:
+            fig3 = px.density_heatmap(filtered_df,
+                                      x="Quantity",
+                                      y="Avg Price",
+                                      nbinsx=60,
+                                      nbinsy=60,
+                                      facet_col="Category",
+                                      title="Unit Price vs Quantity")
+        else:
+            fig3 = px.scatter(filtered_df,
+                              x="Quantity",
+                              y="Avg Price",
+                              size="Amount",
+                              color="Category",
+                              hover_name="Item Name",
+                              render_mode="webgl",
+                              title="Unit Price vs Quantity")
         st.plotly_chart(fig3, use_container_width=True)
 
     st.subheader("🔝 Top Purchases Per Category")
-    cat_metric = st.selectbox("Metric", ["Amount", "Quantity"])
-    per_cat_n = st.slider("Top N per Category", 3, 15, 5)
-
-    for category in sorted(filtered_df["Category"].unique()):
-        st.markdown(f"### {category}")
-        sub = filtered_df[filtered_df["Category"] == category]
-        top_sub = sub.groupby("Item Name")[cat_metric].sum().nlargest(
-            per_cat_n).reset_index()
-        fig = px.bar(top_sub, x="Item Name", y=cat_metric, text_auto=True)
-        st.plotly_chart(fig, use_container_width=True)
+    render_category_tops(filtered_df)
 
     st.subheader("💸 Unusual Price Alerts")
-    unusual = []
-    for cat in filtered_df["Category"].unique():
-        group = filtered_df[filtered_df["Category"] == cat]
-        avg = group["Avg Price"].mean()
-        flagged = group[group["Avg Price"] > avg * 1.5]
-        unusual.append(flagged)
-    outlier_df = pd.concat(unusual)
+    cat_mean = filtered_df.groupby(
+        "Category", observed=True)["Avg Price"].transform("mean")
+    outlier_df = filtered_df[filtered_df["Avg Price"] > cat_mean * 1.5]
     if not outlier_df.empty:
         st.warning(f"{len(outlier_df)} unusually priced items found.")
         st.dataframe(outlier_df)
@@ -216,26 +370,51 @@ if uploaded_file:
 
     with st.expander("📊 Advanced Category Summary"):
         col1, col2 = st.columns(2)
-        avg_by_cat = filtered_df.groupby(
-            "Category")["Avg Price"].mean().reset_index()
-        qty_by_cat = filtered_df.groupby(
-            "Category")["Quantity"].sum().reset_index()
-
-        fig1 = px.bar(avg_by_cat,
-                      x="Category",
-                      y="Avg Price",
-                      text_auto=True,
-                      title="Avg Price per Category")
-        fig2 = px.bar(qty_by_cat,
-                      x="Category",
-                      y="Quantity",
-                      text_auto=True,
-                      title="Total Quantity per Category")
+        fig1 = cached_fig("bar",
+                          cat_totals,
+                          x="Category",
+                          y="Avg Price",
+                          text_auto=True,
+                          title="Avg Price per Category")
+        fig2 = cached_fig("bar",
+                          cat_totals,
+                          x="Category",
+                          y="Quantity",
+                          text_auto=True,
+                          title="Total Quantity per Category")
 
         col1.plotly_chart(fig1, use_container_width=True)
         col2.plotly_chart(fig2, use_container_width=True)
 
 # ---- AI-Powered Analysis ----
+
+
+# One client (and its connection pool) per API key across reruns
+@st.cache_resource
+def get_openai_client(api_key):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+
+# What the LLM sees instead of the full CSV: category aggregates plus the
+# top items for each metric questions rank by (spend, units, unit price)
+def llm_summary(row_count, cat_totals, item_totals):
+    items = item_totals.reset_index()
+    # Spend per unit across all of an item's rows
+    items["Avg Price"] = (items["Amount"] /
+                          items["Quantity"].replace(0, np.nan)).round(2)
+    items["Category"] = tag_category(items["Item Name"])
+    return {
+        "rows": row_count,
+        "by_category": cat_totals.to_dict(orient="records"),
+        "top_items_by": {
+            metric:
+            items.nlargest(PROMPT_TOP_ROWS, metric).to_dict(orient="records")
+            for metric in ["Amount", "Quantity", "Avg Price"]
+        },
+    }
+
+
 with st.expander("🤖 Ask AI About This Data", expanded=True):
     st.markdown(
         "Try asking things like: `Which category had the highest average price?` or `Top 5 expensive items?`"
@@ -253,8 +432,8 @@ with st.expander("🤖 Ask AI About This Data", expanded=True):
 
         if any(x in q for x in
                ["highest average price", "avg price", "costliest category"]):
-            result = filtered_df.groupby(
-                "Category")["Avg Price"].mean().idxmax()
+            result = cat_totals.loc[cat_totals["Avg Price"].idxmax(),
+                                    "Category"]
             return f"📈 The category with the highest average unit price is **{result}**."
 
         elif any(x in q for x in
@@ -277,23 +456,29 @@ with st.expander("🤖 Ask AI About This Data", expanded=True):
             by = "Amount" if "amount" in q or "spend" in q else "Quantity" if "quantity" in q else "Amount"
             top_items = filtered_df.groupby("Item Name")[by].sum().nlargest(
                 n).reset_index()
-            return f"📋 Top {n} items by {by.lower()}:\n" + "\n".join([
-                f"- {row['Item Name']} – ₹{row[by]:,.2f}" if by == "Amount"
-                else f"- {row['Item Name']} – {row[by]} units"
-                for _, row in top_items.iterrows()
-            ])
+            names = top_items["Item Name"].tolist()
+            values = top_items[by].tolist()
+            lines = (
+                [f"- {name} – ₹{v:,.2f}"
+                 for name, v in zip(names, values)] if by == "Amount" else
+                [f"- {name} – {v} units" for name, v in zip(names, values)])
+            return f"📋 Top {n} items by {by.lower()}:\n" + "\n".join(lines)
 
         elif "average price per category" in q:
-            result = filtered_df.groupby(
-                "Category")["Avg Price"].mean().reset_index()
             return "📊 Average price per category:\n" + "\n".join([
-                f"- {r['Category']}: ₹{r['Avg Price']:.2f}"
-                for _, r in result.iterrows()
+                f"- {category}: ₹{price:.2f}"
+                for category, price in zip(cat_totals["Category"].tolist(),
+                                           cat_totals["Avg Price"].tolist())
             ])
 
         else:
             return "🤖 Sorry, I can only answer basic data questions without external AI."
 
+    # filter_key pins the answer to the data it was computed from
+    @st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+    def cached_fallback(question, filter_key):
+        return smart_fallback(question)
+
     if question:
         if filtered_df.empty:
             st.warning(
@@ -303,11 +488,13 @@ with st.expander("🤖 Ask AI About This Data", expanded=True):
                 try:
                     if "OPENAI_API_KEY" in st.secrets and st.secrets[
                             "OPENAI_API_KEY"]:
-                        from openai import OpenAI
-                        client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+                        client = get_openai_client(
+                            st.secrets["OPENAI_API_KEY"])
 
-                        csv_data = filtered_df.to_csv(index=False)
-                        prompt = f"""You're a purchase data assistant. Based on this CSV data:\n\n{csv_data}\n\nAnswer this user question: {question}"""
+                        summary = llm_summary(len(filtered_df), cat_totals,
+                                              item_totals)
+                        summary_json = json.dumps(summary, default=str)
+                        prompt = f"""You're a purchase data assistant. Based on this JSON summary of the purchase data:\n\n{summary_json}\n\nAnswer this user question: {question}"""
 
                         response = client.chat.completions.create(
                             model="gpt-3.5-turbo",
@@ -329,10 +516,10 @@ with st.expander("🤖 Ask AI About This Data", expanded=True):
                         st.warning(
                             "⚠️ No OpenAI API key detected. Using local logic..."
                         )
-                        st.markdown(smart_fallback(question))
+                        st.markdown(cached_fallback(question, filter_key))
 
                 except Exception as e:
                     st.warning(
                         "⚠️ AI not available or quota exceeded. Using local logic..."
                     )
-                    st.markdown(smart_fallback(question))
+                    st.markdown(cached_fallback(question, filter_key))
@@ -0,0 +1,57 @@
+import io
+import multiprocessing
+import re
+
+import pdfplumber
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# One purchase-register row: "<item> <qty> ₹<amount> ₹<avg price> [sku]".
+# Multiline so one finditer walks a whole page. Only ASCII classes are used:
+# RE2's \s and \d are ASCII-only while re's are Unicode, and plain " +"
+# separators also keep each match from spilling across line breaks.
+LINE_RE = re.compile(r"(?m)^(.*?) +([0-9,.]+) +₹([0-9,.]+) +₹([0-9,.]+)"
+                     r"(?: +(.*))?$")
+# RE2 matches in linear time, so header/total lines cannot backtrack
+if re2 is not None:
+    LINE_RE = re2.compile(LINE_RE.pattern)
+
+# Every whitespace character but newline becomes a plain space before
+# matching, so rows separated by non-breaking or other Unicode spaces match
+# under both engines and no tab or CR can land in a captured field
+SPACE_CLEAN = {
+    i: " "
+    for i in range(0x3001) if chr(i).isspace() and chr(i) != "\n"
+}
+
+# Never fork the multithreaded Streamlit server, which can deadlock the
+# child; workers start fresh and import their function from here by name
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in
+    multiprocessing.get_all_start_methods() else "spawn")
+# A fresh worker re-imports main.py (as __mp_main__) before it can run, so
+# the pool is only worth it when each worker gets at least this many pages
+MIN_PAGES_PER_WORKER = 8
+
+
+def extract_rows(path, page_nos):
+    # Matched rows go back as tab-separated text for pandas' C CSV parser
+    buf = io.StringIO()
+    with pdfplumber.open(path) as pdf:
+        for page_no in page_nos:
+            page = pdf.pages[page_no]
+            text = page.extract_text()
+            # Drop the page's parsed char/object caches before the next one
+            page.flush_cache()
+            # Every register row carries two ₹ amounts; skip the regex
+            # entirely for cover pages and other pages without any rows
+            if not text or text.count("₹") < 2:
+                continue
+            for match in LINE_RE.finditer(text.translate(SPACE_CLEAN)):
+                name, qty, amount, avg_price, sku = match.groups()
+                buf.write(f"{name.strip()}\t{qty}\t{amount}\t"
+                          f"{avg_price}\t{(sku or '').strip()}\n")
+    return buf.getvalue()